@@ -25,23 +25,28 @@
 ##############################################################################
 """CLI for SideFX Web API."""
 import argparse
-import base64
 import configparser
-import json
 import logging
 import os
 import pathlib
 import sys
 import time
-import urllib
 
-import requests
+CONFIG_DIR = pathlib.Path.home() / '.config' / 'sidefx-web'
+CONFIG_FILE = CONFIG_DIR / 'config.ini'
+# Refresh the access token if it expires within this many seconds.
+REFRESH_SKEW = 60
+# (connect, read) timeout in seconds for HTTP requests.
+REQUEST_TIMEOUT = (5, 60)
 
-CONFIG_DIR = '/'.join([str(pathlib.Path.home()), '.config', 'sidefx-web'])
-CONFIG_FILE = '/'.join([CONFIG_DIR, 'config.ini'])
+# Parsed config keyed on path, stored with the file's mtime and size.
+_CFG_CACHE = {}
+
+_SESSION = None
 
 
 def cli():
+    _init_logging()
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--access-token-url', type=str,
@@ -96,6 +101,7 @@ def cli():
 
     if args.setup:
         setup()
+        return
 
     cfg = get_config()
     client_id = cfg.get('Auth', 'client_id')
@@ -105,35 +111,49 @@ def cli():
     if token_expiry:
         token_expiry = float(token_expiry)
 
-    log.debug('Access Token URL: {}'.format(args.access_token_url))
-    log.debug('Client ID: {}'.format(client_id))
-    log.debug('Client Secret Key: ******{}'.format(client_secret_key[-6:]))
-    log.debug('Cached Access Token: {}'.format(token))
-    log.debug('Cached Access Token Expiry: {}'.format(token_expiry))
-
-    if (token is None or token_expiry is None or token_expiry < time.time()):
-        log.info('Fetching a new token.')
-        token, token_expiry = get_access_token(
-            args.access_token_url, client_id, client_secret_key)
-
-        if not cfg.has_section('Cache'):
-            cfg.add_section('Cache')
-        cfg.set('Cache', 'access_token', token)
-        cfg.set('Cache', 'access_token_expiry', str(token_expiry))
-        save_config(cfg)
-
-    log.debug('Access Token: {}'.format(token))
-    log.debug('Access Token Expiry Time: {}'.format(token_expiry))
-
-    if hasattr(args, 'func'):
-        if args.func == 'list_builds':
-            list_builds(args.endpoint_url, token, args.product,
-                        version=args.version,
-                        platform=args.platform,
-                        only_production=args.only_production)
-        elif args.func == 'download':
-            download(args.endpoint_url, token,
-                     args.product, args.version, args.build, args.platform)
+    log.debug('Access Token URL: %s', args.access_token_url)
+    log.debug('Client ID: %s', client_id)
+    log.debug('Client Secret Key: ******%s', client_secret_key[-6:])
+    log.debug('Cached Access Token: %s', token)
+    log.debug('Cached Access Token Expiry: %s', token_expiry)
+
+    import requests
+
+    try:
+        cached_token = True
+        if (token is None or token_expiry is None
+                or token_expiry - REFRESH_SKEW < time.time()):
+            token, token_expiry = refresh_access_token(
+                cfg, args.access_token_url, client_id, client_secret_key)
+            cached_token = False
+
+        log.debug('Access Token: %s', token)
+        log.debug('Access Token Expiry Time: %s', token_expiry)
+
+        if hasattr(args, 'func'):
+            try:
+                run_command(args, token)
+            except UnauthorizedError:
+                if not cached_token:
+                    raise
+                log.debug('Cached access token was rejected, retrying.')
+                token, token_expiry = refresh_access_token(
+                    cfg, args.access_token_url, client_id, client_secret_key)
+                run_command(args, token)
+    except (requests.RequestException, UnauthorizedError) as e:
+        log.error('Request failed: %s', e)
+        sys.exit(1)
+
+
+def run_command(args, token):
+    if args.func == 'list_builds':
+        list_builds(args.endpoint_url, token, args.product,
+                    version=args.version,
+                    platform=args.platform,
+                    only_production=args.only_production)
+    elif args.func == 'download':
+        download(args.endpoint_url, token,
+                 args.product, args.version, args.build, args.platform)
 
 
 def download(endpoint_url, token,
@@ -146,8 +166,20 @@ def download(endpoint_url, token,
     log.debug(resp)
     download_url = resp.get('download_url')
     filename = resp.get('filename')
-    log.info('Downloading {}'.format(filename))
-    urllib.request.urlretrieve(download_url, filename)
+    log.info('Downloading %s', filename)
+    partfile = filename + '.part'
+    try:
+        with get_session().get(download_url, stream=True,
+                               timeout=REQUEST_TIMEOUT) as r:
+            r.raise_for_status()
+            with open(partfile, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+    except BaseException:
+        if os.path.exists(partfile):
+            os.remove(partfile)
+        raise
+    os.replace(partfile, filename)
 
 
 def list_builds(endpoint_url, token, product,
@@ -156,69 +188,118 @@ def list_builds(endpoint_url, token, product,
                 only_production=None):
     resp = call_api(endpoint_url, token, 'download.get_daily_builds_list',
                     product, version, platform, only_production)
-    for i in resp:
-        log.info(i)
+    if resp:
+        log.info('\n'.join(map(str, resp)))
 
 
 ############
 # Requests #
 ############
 
+def get_session():
+    """Return a shared HTTP session so connections are kept alive."""
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        _SESSION = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=16)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
 def call_api(endpoint_url, access_token, function_name, *args, **kwargs):
     """Call into the Web API."""
-    response = requests.post(
+    import json
+
+    import requests
+
+    response = get_session().post(
         endpoint_url,
         headers={
             "Authorization": "Bearer " + access_token,
         },
         data=dict(
             json=json.dumps([function_name, args, kwargs]),
-        ))
+        ),
+        timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
         return response.json()
-    log.debug(response.status_code, response.reason, response.text)
+    if response.status_code == 401:
+        raise UnauthorizedError(response.reason)
+    log.debug('%s %s: %s',
+              response.status_code, response.reason, response.text)
+    raise requests.HTTPError(
+        '{} {} for url: {}'.format(
+            response.status_code, response.reason, response.url),
+        response=response)
 
 
 def get_access_token(url, client_id, client_secret_key):
-    auth = base64.b64encode("{}:{}".format(
-        client_id, client_secret_key).encode()
-    ).decode('utf-8')
-    headers = {
-        'Authorization': 'Basic {0}'.format(auth),
-    }
-    req = requests.post(url, headers=headers)
+    from requests.auth import HTTPBasicAuth
 
-    if req.status_code != 200:
-        print('ERROR: {} {}'.format(req.status_code, req.reason))
-        sys.exit(1)
+    req = get_session().post(
+        url, auth=HTTPBasicAuth(client_id, client_secret_key),
+        timeout=REQUEST_TIMEOUT)
+
+    req.raise_for_status()
 
     data = req.json()
-    expiry_time = time.time() - 2 + data['expires_in']
+    expiry_time = time.time() + data['expires_in']
     return data['access_token'], expiry_time
 
 
+def refresh_access_token(cfg, url, client_id, client_secret_key):
+    """Fetch a new access token and store it in the config cache."""
+    log.info('Fetching a new token.')
+    token, token_expiry = get_access_token(url, client_id, client_secret_key)
+
+    if not cfg.has_section('Cache'):
+        cfg.add_section('Cache')
+    cfg.set('Cache', 'access_token', token)
+    cfg.set('Cache', 'access_token_expiry', str(token_expiry))
+    save_config(cfg)
+    return token, token_expiry
+
+
+class UnauthorizedError(Exception):
+    """Raised when the Web API rejects the access token."""
+
+
 #################
 # Configuration #
 #################
 
 def get_config():
-    cfg = configparser.ConfigParser()
+    """Return the parsed config, reusing the cached copy if unchanged."""
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            cfg.read(CONFIG_FILE)
+        st = os.stat(CONFIG_FILE)
     except FileNotFoundError:
         setup()
-        cfg.read(CONFIG_FILE)
+        st = os.stat(CONFIG_FILE)
+
+    cached = _CFG_CACHE.get(CONFIG_FILE)
+    if cached and cached[1:] == (st.st_mtime_ns, st.st_size):
+        return cached[0]
+
+    cfg = configparser.ConfigParser()
+    with open(CONFIG_FILE, 'r') as f:
+        cfg.read_file(f)
+    _CFG_CACHE[CONFIG_FILE] = (cfg, st.st_mtime_ns, st.st_size)
     return cfg
 
 
 def save_config(cfg):
-    cfgfile = pathlib.Path(CONFIG_FILE)
     with open(CONFIG_FILE, 'w') as f:
         cfg.write(f)
         os.chmod(CONFIG_FILE, 0o600)
         log.debug('Saved config file.')
 
+    st = os.stat(CONFIG_FILE)
+    _CFG_CACHE[CONFIG_FILE] = (cfg, st.st_mtime_ns, st.st_size)
+
 
 def setup():
     log.info('Credentials are needed in order to use the SideFX Web API. '
@@ -226,8 +307,8 @@ def setup():
              'https://www.sidefx.com/docs/api/credentials/index.html')
     client_id = input('Enter your Client ID: ')
     client_secret_key = input('Enter your Client Secret Key: ')
-    log.debug('Set Client ID to {}'.format(client_id))
-    log.debug('Set Client Secret Key to {}'.format(client_secret_key))
+    log.debug('Set Client ID to %s', client_id)
+    log.debug('Set Client Secret Key to %s', client_secret_key)
 
     cfg = configparser.ConfigParser()
     if not cfg.has_section('Auth'):
@@ -235,8 +316,7 @@ def setup():
     cfg.set('Auth', 'client_id', client_id)
     cfg.set('Auth', 'client_secret_key', client_secret_key)
 
-    cfgdir = pathlib.Path(CONFIG_DIR)
-    cfgdir.mkdir(parents=True, exist_ok=True)
+    CONFIG_DIR.mkdir(parents=True, exist_ok=True)
     save_config(cfg)
 
 
@@ -247,19 +327,26 @@ class LogFormatter(logging.Formatter):
     debug_fmt = logging.Formatter(
         '%(levelname)s: %(name)s:%(lineno)d: %(message)s')
     info_fmt = logging.Formatter('%(message)s')
+    _FMTS = {
+        logging.INFO: info_fmt,
+        logging.DEBUG: debug_fmt,
+    }
 
     def format(self, record):
         """Format log messages depending on log level."""
-        if record.levelno == logging.INFO:
-            return self.info_fmt.format(record)
-        if record.levelno == logging.DEBUG:
-            return self.debug_fmt.format(record)
-        else:
-            return self.default_fmt.format(record)
-
-
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(LogFormatter())
-logging.getLogger("").setLevel(logging.INFO)
-logging.getLogger("").addHandler(console_handler)
+        return self._FMTS.get(
+            record.levelno, self.default_fmt).format(record)
+
+
+def _init_logging():
+    """Install the console log handler on the root logger once."""
+    root = logging.getLogger("")
+    if any(isinstance(h.formatter, LogFormatter) for h in root.handlers):
+        return
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(LogFormatter())
+    root.setLevel(logging.INFO)
+    root.addHandler(console_handler)
+
+
 log = logging.getLogger(__name__)